@@ -1,30 +1,86 @@
 #!/usr/bin/env python3
+import atexit
+import functools
 import json
+import os
+import queue
 import re
+import signal
 import subprocess
+import sys
+import tempfile
+import threading
 import time
-from dataclasses import dataclass
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import paho.mqtt.client as mqtt
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-@dataclass
+try:
+    import re2 as fast_re  # google-re2: linear-time, same compile/match API
+except ImportError:
+    fast_re = re
+
+
+@dataclass(slots=True)
 class AP:
     name: str
     host: str
     floor: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Device:
     mac: str
     name: str
     allow_randomized: bool = False
+    topic: str = ""  # combined state+attributes topic, filled in at discovery
 
 
-@dataclass
+@dataclass(slots=True)
+class StationRec:
+    # one parsed wlanconfig row; None = column missing or unparsable
+    mac: str
+    flags: int = 0  # first-octet MAC_GROUP_BIT / MAC_LOCAL_BIT, see mac_flags()
+    rssi: Optional[int] = None
+    min_rssi: Optional[int] = None
+    max_rssi: Optional[int] = None
+    idle_s: Optional[int] = None
+    chan: Optional[int] = None
+    tx_rate_raw: Optional[str] = None
+    tx_mbps: Optional[float] = None
+    rx_rate_raw: Optional[str] = None
+    rx_mbps: Optional[float] = None
+    mode: Optional[str] = None
+    psmode: Optional[str] = None
+    assoctime: Optional[str] = None
+
+
+# StationRec fields copied into the published attributes in extended mode
+STATION_EXTENDED_KEYS = (
+    "chan",
+    "tx_rate_raw",
+    "rx_rate_raw",
+    "tx_mbps",
+    "rx_mbps",
+    "min_rssi",
+    "max_rssi",
+    "idle_s",
+    "mode",
+    "psmode",
+    "assoctime",
+)
+
+
+@dataclass(slots=True)
 class SSHConfig:
     username: str
     password: str
@@ -34,7 +90,7 @@ class SSHConfig:
     known_hosts_strict: bool
 
 
-@dataclass
+@dataclass(slots=True)
 class MQTTConfig:
     host: str
     port: int
@@ -45,7 +101,7 @@ class MQTTConfig:
     client_id: str
 
 
-@dataclass
+@dataclass(slots=True)
 class ConfidenceConfig:
     enabled: bool
     rssi_thresholds: List[int]
@@ -59,18 +115,130 @@ class ConfidenceConfig:
     ssid_penalty: int
     clamp_min: int
     clamp_max: int
+    # all ssid_penalty_patterns as one alternation; None when there are none
+    ssid_penalty_re: Optional[re.Pattern] = field(default=None, init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        if self.ssid_penalty_patterns:
+            self.ssid_penalty_re = re.compile("|".join(map(re.escape, self.ssid_penalty_patterns)))
 
 
 OPTIONS_PATH = "/data/options.json"
-LEARN_SEEN_PATH = "/data/seen_devices.json"
+# Learn mode log: append-only JSON lines, compacted when it grows past
+# LEARN_COMPACT_RATIO x live entries or when entries are trimmed.
+LEARN_SEEN_PATH = "/data/seen_devices.jsonl"
+LEARN_SEEN_LEGACY_PATH = "/data/seen_devices.json"
+LEARN_COMPACT_RATIO = 2
+
+# ("append" | "compact", items) jobs for seen_writer_loop
+seen_write_queue: "queue.Queue[Tuple[str, List[dict]]]" = queue.Queue()
+
+# OpenSSH connection multiplexing: one long-lived master per AP.
+SSH_CONTROL_PATH = "/tmp/unifi-%r@%h:%p"
+SSH_CONTROL_PERSIST_SEC = 600  # idle masters exit on their own after 10 min
+
+# host -> control socket path of a running master
+ssh_masters: Dict[str, str] = {}
+
+IFACE_LIST_CMD = r"ls -1 /sys/class/net 2>/dev/null | grep -E '^wifi[0-9]+ap[0-9]+$' | sort"
+
+# Column extraction runs on the AP: awk finds the ADDR header, resolves each
+# wanted column to an index once (first alias present wins) and prints one
+# TSV row per station: MAC, then WLAN_COLUMNS in order ("" when missing).
+# parse_wlanconfig_list() unpacks the rows in this same order.
+WLAN_COLUMNS: Tuple[Tuple[str, ...], ...] = (
+    ("RSSI",),
+    ("MINRSSI", "MIN_RSSI"),
+    ("MAXRSSI", "MAX_RSSI"),
+    ("IDLE", "IDLE_S"),
+    ("CHAN", "CHANNEL"),
+    ("TXRATE", "TX_RATE", "TX"),
+    ("RXRATE", "RX_RATE", "RX"),
+    ("MODE",),
+    ("PSMODE",),
+    ("ASSOCTIME",),
+)
+WLAN_TSV_COLS = " ".join(",".join(aliases) for aliases in WLAN_COLUMNS)
+WLAN_TSV_FIELDS = 1 + len(WLAN_COLUMNS)
+WLAN_AWK = (
+    f"awk -v cols='{WLAN_TSV_COLS}' '"
+    r'BEGIN { n = split(cols, spec, " ") } '
+    r'!hdr && toupper($1) ~ /^ADDR/ { '
+    r'for (i = 1; i <= NF; i++) h[toupper($i)] = i; '
+    r'for (k = 1; k <= n; k++) { c[k] = 0; m = split(spec[k], al, ","); '
+    r'for (j = 1; j <= m; j++) if (al[j] in h) { c[k] = h[al[j]]; break } } '
+    r'hdr = 1; next } '
+    r'hdr && NF { s = $1; for (k = 1; k <= n; k++) s = s "\t" ((c[k] && c[k] <= NF) ? $(c[k]) : ""); print s }'
+    "'"
+)
+
+PUBLISH_HEARTBEAT_EVERY_CYCLES = 10  # ~15 minutes if poll is 90s
+PUBLISH_FLUSH_TIMEOUT_SEC = 0.5
+
+# Attributes that change every cycle without carrying new information; they
+# are refreshed by the heartbeat instead of forcing a publish each poll.
+VOLATILE_ATTR_KEYS = frozenset(("last_seen_ts", "last_seen_iso", "misses"))
+SSID_REFRESH_EVERY_CYCLES = 20  # ~30 minutes if poll is 90s
+
+# Per-field patterns used for every station row; compiled once, via re2 if present.
+INT_RE = fast_re.compile(r"-?\d+")
+RATE_RE = fast_re.compile(r"^\s*(-?\d+(?:\.\d+)?)\s*([kKmMgG]?)\s*$")
+NUM_RE = fast_re.compile(r"-?\d+(?:\.\d+)?")
+
+HOSTAPD_SSID_RE = re.compile(r"^/etc/hostapd/([^:/]+)\.cfg:ssid=(.*)$")
+AP_FLOOR_RE = re.compile(r"^ap_(.+)$", re.IGNORECASE)
+
+HEX_CHARS = frozenset("0123456789abcdefABCDEF")
+
+# first MAC octet (lower-case hex) -> its group / locally administered bits
+MAC_GROUP_BIT = 0b00000001  # multicast, incl. ff:ff:ff:ff:ff:ff
+MAC_LOCAL_BIT = 0b00000010  # locally administered = randomized
+MAC_OCTET_FLAGS = {f"{b:02x}": b & (MAC_GROUP_BIT | MAC_LOCAL_BIT) for b in range(256)}
+
+
+def is_mac(s: str) -> bool:
+    # aa:bb:cc:dd:ee:ff, checked without the regex engine
+    return (
+        len(s) == 17
+        and s[2] == ":" and s[5] == ":" and s[8] == ":" and s[11] == ":" and s[14] == ":"
+        and s[0] in HEX_CHARS and s[1] in HEX_CHARS
+        and s[3] in HEX_CHARS and s[4] in HEX_CHARS
+        and s[6] in HEX_CHARS and s[7] in HEX_CHARS
+        and s[9] in HEX_CHARS and s[10] in HEX_CHARS
+        and s[12] in HEX_CHARS and s[13] in HEX_CHARS
+        and s[15] in HEX_CHARS and s[16] in HEX_CHARS
+    )
+
+
+def is_ipv4(s: str) -> bool:
+    parts = s.split(".")
+    if len(parts) != 4:
+        return False
+    for p in parts:
+        if not (0 < len(p) <= 3 and p.isascii() and p.isdigit() and int(p) < 256):
+            return False
+    return True
+
+
+# Shared stdlib encoder for the fallback path; compact like orjson's output.
+JSON_ENCODE = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
 
-MAC_RE = re.compile(r"^([0-9a-f]{2}:){5}[0-9a-f]{2}$", re.IGNORECASE)
-IPV4_RE = re.compile(r"^\d{1,3}(\.\d{1,3}){3}$")
+
+def json_dumps(obj: object) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return JSON_ENCODE(obj).encode("utf-8")
+
+
+def json_loads(data: bytes) -> object:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
 
 def load_options() -> dict:
-    with open(OPTIONS_PATH, "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open(OPTIONS_PATH, "rb") as f:
+        return json_loads(f.read())
 
 
 def sh(cmd: List[str], timeout: int) -> Tuple[int, str, str]:
@@ -84,47 +252,116 @@ def sh(cmd: List[str], timeout: int) -> Tuple[int, str, str]:
         return 124, out, err
 
 
-def ssh_run(host: str, sshc: SSHConfig, remote_cmd: str) -> Tuple[int, str, str]:
-    strict = sshc.known_hosts_strict
+def ssh_base_opts(sshc: SSHConfig) -> List[str]:
     ssh_opts = [
         "-o", f"ConnectTimeout={sshc.connect_timeout_sec}",
-        "-o", "BatchMode=no",
         "-o", "LogLevel=ERROR",
+        "-o", f"ControlPath={SSH_CONTROL_PATH}",
     ]
-    if not strict:
+    if not sshc.known_hosts_strict:
         ssh_opts += ["-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null"]
+    return ssh_opts
 
+
+def ssh_control_socket(host: str, sshc: SSHConfig) -> str:
+    return SSH_CONTROL_PATH.replace("%r", sshc.username).replace("%h", host).replace("%p", str(sshc.port))
+
+
+def ssh_session_init(host: str, sshc: SSHConfig) -> None:
+    # Password auth happens only here; the backgrounded master keeps the
+    # TCP/SSH session open and later ssh_run calls just open a new channel.
     cmd = [
         "sshpass", "-p", sshc.password,
         "ssh",
-        *ssh_opts,
+        *ssh_base_opts(sshc),
+        "-o", "BatchMode=no",
+        "-o", "ControlMaster=yes",
+        "-o", f"ControlPersist={SSH_CONTROL_PERSIST_SEC}",
+        "-M", "-N", "-f",
+        "-p", str(sshc.port),
+        f"{sshc.username}@{host}",
+    ]
+    # The forked master may inherit our stderr, so never read it through a pipe.
+    with tempfile.TemporaryFile(mode="w+") as errf:
+        p = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=errf, text=True)
+        try:
+            rc = p.wait(timeout=sshc.connect_timeout_sec + sshc.cmd_timeout_sec)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
+            rc = 124
+        errf.seek(0)
+        err = errf.read()
+    if rc != 0:
+        raise RuntimeError(f"ssh master failed on {host} rc={rc} err={err.strip()}")
+    ssh_masters[host] = ssh_control_socket(host, sshc)
+
+
+def ssh_session_close(host: str, sshc: SSHConfig) -> None:
+    ssh_masters.pop(host, None)
+    cmd = ["ssh", *ssh_base_opts(sshc), "-O", "exit", "-p", str(sshc.port), f"{sshc.username}@{host}"]
+    sh(cmd, timeout=5)
+    # a master that died on its own leaves the socket behind, and a new
+    # ControlMaster=yes would then silently run without multiplexing
+    try:
+        os.unlink(ssh_control_socket(host, sshc))
+    except OSError:
+        pass
+
+
+def ssh_close_all(sshc: SSHConfig) -> None:
+    for host in list(ssh_masters):
+        try:
+            ssh_session_close(host, sshc)
+        except Exception:
+            pass
+
+
+def ssh_run(host: str, sshc: SSHConfig, remote_cmd: str) -> Tuple[int, str, str]:
+    sock = ssh_masters.get(host)
+    if sock is None or not os.path.exists(sock):
+        ssh_session_init(host, sshc)
+
+    # Multiplexed client: never falls back to an interactive password prompt.
+    cmd = [
+        "ssh",
+        *ssh_base_opts(sshc),
+        "-o", "BatchMode=yes",
+        "-o", "ControlMaster=no",
         "-p", str(sshc.port),
         f"{sshc.username}@{host}",
         remote_cmd
     ]
-    return sh(cmd, timeout=sshc.cmd_timeout_sec)
+    rc, out, err = sh(cmd, timeout=sshc.cmd_timeout_sec)
+    if rc == 255:
+        # Transport-level failure (AP rebooted, master lost): reconnect once
+        # right away instead of losing this cycle's poll.
+        ssh_session_close(host, sshc)
+        try:
+            ssh_session_init(host, sshc)
+        except RuntimeError:
+            return rc, out, err
+        rc, out, err = sh(cmd, timeout=sshc.cmd_timeout_sec)
+        if rc == 255:
+            ssh_masters.pop(host, None)
+    return rc, out, err
 
 
 def get_wifi_ifaces(host: str, sshc: SSHConfig) -> List[str]:
-    remote = r"ls -1 /sys/class/net 2>/dev/null | grep -E '^wifi[0-9]+ap[0-9]+$' | sort"
-    rc, out, err = ssh_run(host, sshc, remote)
+    rc, out, err = ssh_run(host, sshc, IFACE_LIST_CMD)
     if rc != 0:
         raise RuntimeError(f"iface detect failed on {host} rc={rc} err={err.strip()}")
-    return [line.strip() for line in out.splitlines() if line.strip()]
-
-
-def get_col(parts: List[str], col_index: Dict[str, int], names: List[str]) -> Optional[str]:
-    for name in names:
-        idx = col_index.get(name)
-        if idx is not None and idx < len(parts):
-            return parts[idx]
-    return None
+    # one name per line, no spaces inside: a bare split() does strip + filter
+    return out.split()
 
 
 def parse_int_field(raw: Optional[str]) -> Optional[int]:
     if raw is None:
         return None
-    m = re.search(r"-?\d+", raw)
+    # plain integer columns are the common case; the regex handles the rest
+    if raw.isascii() and (raw.isdigit() or (raw[:1] == "-" and raw[1:].isdigit())):
+        return int(raw)
+    m = INT_RE.search(raw)
     if not m:
         return None
     try:
@@ -136,9 +373,18 @@ def parse_int_field(raw: Optional[str]) -> Optional[int]:
 def parse_rate_mbps(raw: Optional[str]) -> Optional[float]:
     if not raw:
         return None
-    m = re.match(r"^\s*(-?\d+(?:\.\d+)?)\s*([kKmMgG]?)\s*$", raw)
+    # fast path for the usual "<digits><suffix>" form, e.g. "866M"
+    suffix = raw[-1]
+    if suffix in "kKmMgG":
+        digits = raw[:-1]
+    else:
+        digits, suffix = raw, ""
+    if digits.isascii() and digits.isdigit():
+        return scale_rate_mbps(float(digits), suffix)
+
+    m = RATE_RE.match(raw)
     if not m:
-        m_num = re.search(r"-?\d+(?:\.\d+)?", raw)
+        m_num = NUM_RE.search(raw)
         if not m_num:
             return None
         try:
@@ -152,7 +398,11 @@ def parse_rate_mbps(raw: Optional[str]) -> Optional[float]:
     except Exception:
         return None
 
-    suffix = (m.group(2) or "").upper()
+    return scale_rate_mbps(val, m.group(2) or "")
+
+
+def scale_rate_mbps(val: float, suffix: str) -> float:
+    suffix = suffix.upper()
     if suffix == "K":
         val = val / 1000.0
     elif suffix == "G":
@@ -161,103 +411,64 @@ def parse_rate_mbps(raw: Optional[str]) -> Optional[float]:
     return int(val) if val.is_integer() else round(val, 2)
 
 
-def parse_wlanconfig_list(output: str, extended: bool = False) -> Dict[str, Dict]:
-    lines = [ln.strip() for ln in output.splitlines() if ln.strip()]
-    if not lines:
-        return {}
-
-    header_idx = None
-    for i, ln in enumerate(lines):
-        if ln.upper().startswith("ADDR"):
-            header_idx = i
-            break
-    if header_idx is None or header_idx == len(lines) - 1:
-        return {}
-
-    header = re.split(r"\s+", lines[header_idx])
-    col_index = {name.upper(): idx for idx, name in enumerate(header)}
-
-    results: Dict[str, Dict] = {}
-    for ln in lines[header_idx + 1:]:
-        parts = re.split(r"\s+", ln)
-        if not parts:
+def parse_wlanconfig_list(lines: Iterable[str], extended: bool = False) -> Dict[str, StationRec]:
+    # input is the TSV produced by WLAN_AWK, not raw wlanconfig output
+    results: Dict[str, StationRec] = {}
+    for ln in lines:
+        parts = ln.split("\t")
+        if len(parts) != WLAN_TSV_FIELDS:
             continue
         mac = parts[0].lower()
-        if not MAC_RE.match(mac):
+        if not is_mac(mac):
             continue
 
-        rec: Dict = {"mac": mac}
+        (
+            _, rssi_raw, min_rssi_raw, max_rssi_raw, idle_raw, chan_raw,
+            tx_rate_raw, rx_rate_raw, mode, psmode, assoctime,
+        ) = parts
 
-        rssi = parse_int_field(get_col(parts, col_index, ["RSSI"]))
-        if rssi is not None:
-            rec["rssi"] = rssi
+        rec = StationRec(mac, flags=mac_flags(mac), rssi=parse_int_field(rssi_raw))
 
         if extended:
-            min_rssi = parse_int_field(get_col(parts, col_index, ["MINRSSI", "MIN_RSSI"]))
-            if min_rssi is not None:
-                rec["min_rssi"] = min_rssi
-
-            max_rssi = parse_int_field(get_col(parts, col_index, ["MAXRSSI", "MAX_RSSI"]))
-            if max_rssi is not None:
-                rec["max_rssi"] = max_rssi
-
-            idle_s = parse_int_field(get_col(parts, col_index, ["IDLE", "IDLE_S"]))
-            if idle_s is not None:
-                rec["idle_s"] = idle_s
-
-            chan = parse_int_field(get_col(parts, col_index, ["CHAN", "CHANNEL"]))
-            if chan is not None:
-                rec["chan"] = chan
-
-            tx_rate_raw = get_col(parts, col_index, ["TXRATE", "TX_RATE", "TX"])
+            rec.min_rssi = parse_int_field(min_rssi_raw)
+            rec.max_rssi = parse_int_field(max_rssi_raw)
+            rec.idle_s = parse_int_field(idle_raw)
+            rec.chan = parse_int_field(chan_raw)
             if tx_rate_raw:
-                rec["tx_rate_raw"] = tx_rate_raw
-                tx_mbps = parse_rate_mbps(tx_rate_raw)
-                if tx_mbps is not None:
-                    rec["tx_mbps"] = tx_mbps
-
-            rx_rate_raw = get_col(parts, col_index, ["RXRATE", "RX_RATE", "RX"])
+                rec.tx_rate_raw = tx_rate_raw
+                rec.tx_mbps = parse_rate_mbps(tx_rate_raw)
             if rx_rate_raw:
-                rec["rx_rate_raw"] = rx_rate_raw
-                rx_mbps = parse_rate_mbps(rx_rate_raw)
-                if rx_mbps is not None:
-                    rec["rx_mbps"] = rx_mbps
-
-            mode = get_col(parts, col_index, ["MODE"])
-            if mode:
-                rec["mode"] = mode
-
-            psmode = get_col(parts, col_index, ["PSMODE"])
-            if psmode:
-                rec["psmode"] = psmode
-
-            assoctime = get_col(parts, col_index, ["ASSOCTIME"])
-            if assoctime:
-                rec["assoctime"] = assoctime
+                rec.rx_rate_raw = rx_rate_raw
+                rec.rx_mbps = parse_rate_mbps(rx_rate_raw)
+            rec.mode = mode or None
+            rec.psmode = psmode or None
+            rec.assoctime = assoctime or None
 
         results[mac] = rec
 
     return results
 
 
-def parse_ip_neigh(output: str) -> Dict[str, str]:
+def parse_ip_neigh(lines: Iterable[str]) -> Dict[str, str]:
     mac_to_ip: Dict[str, str] = {}
-    for ln in output.splitlines():
-        ln = ln.strip()
-        if not ln:
-            continue
+    for ln in lines:
         parts = ln.split()
         if len(parts) < 5:
             continue
         ip = parts[0]
-        if not IPV4_RE.match(ip):
+        if not is_ipv4(ip):
             continue
-        try:
-            i = parts.index("lladdr")
-            mac = parts[i + 1].lower()
-        except (ValueError, IndexError):
+        # "<ip> dev <iface> lladdr <mac> <state>"; one pass to the token after lladdr
+        it = iter(parts)
+        next(it)
+        for tok in it:
+            if tok == "lladdr":
+                mac = next(it, "").lower()
+                break
+        else:
+            # FAILED/INCOMPLETE entries carry no lladdr
             continue
-        if MAC_RE.match(mac):
+        if is_mac(mac):
             mac_to_ip[mac] = ip
     return mac_to_ip
 
@@ -278,7 +489,7 @@ def parse_hostapd_ssid_map(output: str) -> Dict[str, str]:
         ln = ln.strip()
         if not ln:
             continue
-        m = re.match(r"^/etc/hostapd/([^:/]+)\.cfg:ssid=(.*)$", ln)
+        m = HOSTAPD_SSID_RE.match(ln)
         if not m:
             continue
         iface = m.group(1).strip()
@@ -300,7 +511,7 @@ def floor_from_ap_name(name: str) -> str:
     n = (name or "").strip()
     if not n:
         return "unknown"
-    m = re.match(r"(?i)^ap_(.+)$", n)
+    m = AP_FLOOR_RE.match(n)
     if m and m.group(1).strip():
         return m.group(1).strip()
     return n
@@ -430,10 +641,9 @@ def load_confidence_config(opts: dict) -> ConfidenceConfig:
 
 
 def bucket_score(value: float, thresholds: List[int], scores: List[int]) -> int:
-    for i, threshold in enumerate(thresholds):
-        if value < threshold:
-            return int(scores[i])
-    return int(scores[-1])
+    # thresholds are strictly increasing and len(scores) == len(thresholds) + 1
+    # (enforced when the options are parsed), so this is a binary search
+    return int(scores[bisect_right(thresholds, value)])
 
 
 def numeric_or_none(value: object) -> Optional[float]:
@@ -471,9 +681,8 @@ def compute_presence_confidence(rec: dict, cfg: ConfidenceConfig) -> Tuple[int,
 
     ssid_penalty_applied = 0
     ssid = rec.get("ssid")
-    if isinstance(ssid, str) and ssid:
-        ssid_low = ssid.lower()
-        if any(pattern in ssid_low for pattern in cfg.ssid_penalty_patterns):
+    if isinstance(ssid, str) and ssid and cfg.ssid_penalty_re is not None:
+        if cfg.ssid_penalty_re.search(ssid.lower()):
             ssid_penalty_applied = cfg.ssid_penalty
 
     raw = rssi_score + idle_score + rate_score + band_bonus - ssid_penalty_applied
@@ -483,31 +692,29 @@ def compute_presence_confidence(rec: dict, cfg: ConfidenceConfig) -> Tuple[int,
     return int(score), breakdown
 
 
-def is_randomized_mac(mac: str) -> bool:
-    # locally administered bit = 1 in first octet (0x02)
-    try:
-        first_octet = int(mac.split(":")[0], 16)
-    except Exception:
-        return False
-    return bool(first_octet & 0b00000010)
+def mac_flags(mac: str) -> int:
+    # one lookup for both first-octet bits; expects a validated, lower-case MAC
+    return MAC_OCTET_FLAGS[mac[0:2]]
 
 
-def is_multicast_or_broadcast(mac: str) -> bool:
-    if mac.lower() == "ff:ff:ff:ff:ff:ff":
-        return True
-    try:
-        first_octet = int(mac.split(":")[0], 16)
-    except Exception:
-        return False
-    return bool(first_octet & 0b00000001)
+class _SlugTable(dict):
+    # str.translate() map: keeps [a-z0-9], everything else (incl. non-ASCII
+    # like diacritics, which a fixed 256-entry table would miss) becomes "_"
+    def __missing__(self, code: int) -> str:
+        c = chr(code)
+        v = c if ("a" <= c <= "z" or "0" <= c <= "9") else "_"
+        self[code] = v
+        return v
+
 
+_SLUG_TABLE = _SlugTable()
 
+
+@functools.lru_cache(maxsize=512)
 def slugify(s: str) -> str:
-    s = s.strip().lower()
-    s = re.sub(r"[^a-z0-9]+", "_", s)
-    s = re.sub(r"_+", "_", s)
-    s = s.strip("_")
-    return s or "device"
+    s = s.strip().lower().translate(_SLUG_TABLE)
+    # collapse runs of "_" and trim them from both ends in one go
+    return "_".join(filter(None, s.split("_"))) or "device"
 
 
 def object_id_for_device(dev: Device) -> str:
@@ -526,6 +733,10 @@ def attr_topic(base: str, mac: str) -> str:
     return f"{base}/{mac}/attributes"
 
 
+def combined_topic(base: str, mac: str) -> str:
+    return f"{base}/{mac}/json"
+
+
 def publish_discovery(client: mqtt.Client, cfg: MQTTConfig, dev: Device) -> None:
     obj_id = object_id_for_device(dev)
     topic = discovery_topic(cfg.discovery_prefix, "unifi_ssh_presence", obj_id)
@@ -534,10 +745,11 @@ def publish_discovery(client: mqtt.Client, cfg: MQTTConfig, dev: Device) -> None
         "has_entity_name": True,
         "unique_id": obj_id,
         "source_type": "router",
-        "state_topic": state_topic(cfg.base_topic, dev.mac),
+        "state_topic": dev.topic,
+        "value_template": "{{ value_json.state }}",
         "payload_home": "home",
         "payload_not_home": "not_home",
-        "json_attributes_topic": attr_topic(cfg.base_topic, dev.mac),
+        "json_attributes_topic": dev.topic,
         "device": {
             "identifiers": [obj_id],
             "manufacturer": "Custom",
@@ -545,47 +757,65 @@ def publish_discovery(client: mqtt.Client, cfg: MQTTConfig, dev: Device) -> None
             "name": dev.name,
         },
     }
-    client.publish(topic, json.dumps(payload, ensure_ascii=False), qos=1, retain=True)
+    client.publish(topic, json_dumps(payload), qos=1, retain=True)
+
 
+def clear_legacy_topics(client: mqtt.Client, cfg: MQTTConfig, mac: str) -> None:
+    # state/attributes used to be separate retained topics; drop them
+    client.publish(state_topic(cfg.base_topic, mac), b"", qos=1, retain=True)
+    client.publish(attr_topic(cfg.base_topic, mac), b"", qos=1, retain=True)
 
-def publish_state(client: mqtt.Client, cfg: MQTTConfig, mac: str, is_home: bool) -> None:
-    client.publish(
-        state_topic(cfg.base_topic, mac),
-        "home" if is_home else "not_home",
-        qos=1,
+
+# State + attributes go out as one retained JSON message with QoS 0: it is
+# republished at least every heartbeat, so a lost message self-corrects
+# without a PUBACK round-trip per device. Discovery stays at QoS 1.
+def publish_presence(client: mqtt.Client, dev: Device, payload: dict) -> mqtt.MQTTMessageInfo:
+    # payload = attributes + "state": "home" | "not_home"
+    return client.publish(
+        dev.topic,
+        json_dumps(payload),
+        qos=0,
         retain=True,
     )
 
 
-def publish_attrs(client: mqtt.Client, cfg: MQTTConfig, mac: str, attrs: dict) -> None:
-    client.publish(
-        attr_topic(cfg.base_topic, mac),
-        json.dumps(attrs, ensure_ascii=False),
-        qos=1,
-        retain=True,
+def publish_batch(client: mqtt.Client, outbox: List[Tuple[Device, dict]]) -> None:
+    # Publish a whole cycle back to back on the persistent connection, then
+    # wait on the last message only: the network thread writes in order, so
+    # that flushes the batch.
+    last: Optional[mqtt.MQTTMessageInfo] = None
+    for dev, payload in outbox:
+        last = publish_presence(client, dev, payload)
+    if last is not None and last.rc == mqtt.MQTT_ERR_SUCCESS:
+        last.wait_for_publish(PUBLISH_FLUSH_TIMEOUT_SEC)
+
+
+def attrs_signature(attrs: dict) -> int:
+    # all attribute values are scalars, so hash the items directly instead of
+    # serializing; JSON is only encoded when publish_presence() actually runs
+    return hash(frozenset(kv for kv in attrs.items() if kv[0] not in VOLATILE_ATTR_KEYS))
+
+
+def rank_key(rssi: Optional[int], idle: Optional[int]) -> Tuple[bool, int, bool, int]:
+    # higher is better: known rssi, stronger rssi, known idle, shorter idle
+    return (
+        rssi is not None,
+        rssi if rssi is not None else 0,
+        idle is not None,
+        -idle if idle is not None else 0,
     )
 
 
-def best_record(a: dict, b: dict) -> dict:
-    ar = a.get("rssi")
-    br = b.get("rssi")
-    if ar is None and br is not None:
-        return b
-    if br is None and ar is not None:
-        return a
-    if ar is not None and br is not None and ar != br:
-        return a if ar >= br else b
+def record_rank(rec: dict) -> Tuple[bool, int, bool, int]:
+    return rank_key(rec.get("rssi"), rec.get("idle_s"))
 
-    ai = a.get("idle_s")
-    bi = b.get("idle_s")
-    if ai is None and bi is not None:
-        return b
-    if bi is None and ai is not None:
-        return a
-    if ai is not None and bi is not None and ai != bi:
-        return a if ai <= bi else b
 
-    return a
+def merge_best(best: Dict[str, dict], ranks: Dict[str, tuple], mac: str, rec: dict, r: tuple) -> None:
+    # keep the best record per MAC; ranks is a parallel dict so each record
+    # is ranked once, and ties keep the record seen first
+    if mac not in ranks or r > ranks[mac]:
+        best[mac] = rec
+        ranks[mac] = r
 
 
 def now_ts_iso() -> Tuple[int, str]:
@@ -594,37 +824,83 @@ def now_ts_iso() -> Tuple[int, str]:
     return ts, iso
 
 
-def load_seen_devices() -> Dict[str, dict]:
+def load_seen_devices() -> Tuple[Dict[str, dict], int]:
+    """Replay the learn log (last record per MAC wins).
+
+    Returns (seen map, number of log lines). Falls back to the legacy
+    single-document JSON file. A line count of 0 with a non-empty map
+    (legacy file, or a torn line left by a crash) tells the caller to
+    rewrite the log right away.
+    """
+    out: Dict[str, dict] = {}
+    lines = 0
+    torn = False
     try:
-        with open(LEARN_SEEN_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            seen = data.get("seen", [])
-            out: Dict[str, dict] = {}
-            for item in seen:
+        with open(LEARN_SEEN_PATH, "rb") as f:
+            for raw in f:
+                if not raw.strip():
+                    continue
+                lines += 1
+                try:
+                    item = json_loads(raw)
+                except Exception:
+                    torn = True
+                    continue
                 mac = (item.get("mac") or "").lower().strip()
-                if MAC_RE.match(mac):
+                if is_mac(mac):
                     out[mac] = item
-            return out
+        return out, 0 if torn else lines
+    except FileNotFoundError:
+        pass
     except Exception:
-        return {}
+        return {}, 0
 
+    try:
+        with open(LEARN_SEEN_LEGACY_PATH, "rb") as f:
+            data = json_loads(f.read())
+        for item in data.get("seen", []):
+            mac = (item.get("mac") or "").lower().strip()
+            if is_mac(mac):
+                out[mac] = item
+    except Exception:
+        return {}, 0
+    return out, 0
 
-def save_seen_devices(seen_map: Dict[str, dict]) -> None:
-    items = list(seen_map.values())
-    items.sort(key=lambda x: int(x.get("last_seen_ts") or 0), reverse=True)
-    payload = {
-        "updated_at": datetime.now(timezone.utc).isoformat(),
-        "seen": items,
-    }
 
-    tmp = LEARN_SEEN_PATH + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False, indent=2)
+def append_seen_devices(items: List[dict]) -> None:
+    with open(LEARN_SEEN_PATH, "ab") as f:
+        f.write(b"".join(json_dumps(item) + b"\n" for item in items))
+
 
-    import os
+def compact_seen_devices(items: List[dict]) -> None:
+    items = sorted(items, key=lambda x: int(x.get("last_seen_ts") or 0), reverse=True)
+    tmp = LEARN_SEEN_PATH + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(b"".join(json_dumps(item) + b"\n" for item in items))
     os.replace(tmp, LEARN_SEEN_PATH)
 
 
+def seen_writer_loop() -> None:
+    # Serializes learn-file writes off the poll loop, in submission order.
+    while True:
+        op, items = seen_write_queue.get()
+        try:
+            if op == "append":
+                append_seen_devices(items)
+            else:
+                compact_seen_devices(items)
+        except Exception as e:
+            print(f"[warn] failed saving learn file: {e}")
+        finally:
+            seen_write_queue.task_done()
+
+
+def flush_seen_devices(items: List[dict]) -> None:
+    # shutdown: let queued appends land, then leave a compacted file behind
+    seen_write_queue.put(("compact", items))
+    seen_write_queue.join()
+
+
 def trim_seen(seen_map: Dict[str, dict], max_entries: int) -> Dict[str, dict]:
     if max_entries <= 0:
         return {}
@@ -634,13 +910,181 @@ def trim_seen(seen_map: Dict[str, dict], max_entries: int) -> Dict[str, dict]:
     return {item["mac"].lower(): item for item in kept if "mac" in item}
 
 
+def build_poll_cmd(ifaces: List[str]) -> str:
+    # Single SSH per AP per cycle; mark sections for parsing
+    parts: List[str] = []
+    parts.append("echo '###IFACES_BEGIN'")
+    parts.append(IFACE_LIST_CMD)
+    parts.append("echo '###IFACES_END'")
+    parts.append("echo '###NEIGH_BEGIN'")
+    parts.append("ip neigh show 2>/dev/null || true")
+    parts.append("echo '###NEIGH_END'")
+    for iface in ifaces:
+        parts.append(f"echo '###IFACE {iface} BEGIN'")
+        parts.append(f"wlanconfig {iface} list 2>/dev/null | {WLAN_AWK} || true")
+        parts.append(f"echo '###IFACE {iface} END'")
+    return "; ".join(parts)
+
+
+def poll_ap(
+    ap: AP,
+    sshc: SSHConfig,
+    cycle: int,
+    device_by_mac: Dict[str, Device],
+    learn_mode: bool,
+    extended_mode: bool,
+    confidence_cfg: Optional[ConfidenceConfig],
+    iface_cache: Dict[str, List[str]],
+    ssid_cache: Dict[str, Dict[str, str]],
+    ssid_cache_cycle: Dict[str, int],
+    remote_cmd_cache: Dict[str, Tuple[Tuple[str, ...], str]],
+) -> Tuple[Dict[str, dict], Dict[str, dict]]:
+    """Poll one AP; returns (tracked, unknown) best records keyed by MAC.
+
+    Runs in a worker thread. The caches are keyed by ap.host, so each
+    worker only touches its own entries.
+    """
+    try:
+        # bootstrap only; afterwards the list is refreshed by the ###IFACES
+        # section of the regular poll command below
+        if ap.host not in iface_cache:
+            iface_cache[ap.host] = get_wifi_ifaces(ap.host, sshc)
+        ifaces = iface_cache[ap.host]
+
+        ssid_by_iface: Dict[str, str] = {}
+        if extended_mode:
+            ssid_refresh = (
+                ap.host not in ssid_cache
+                or (cycle - ssid_cache_cycle.get(ap.host, 0) >= SSID_REFRESH_EVERY_CYCLES)
+            )
+            if ssid_refresh:
+                ssid_cache[ap.host] = get_hostapd_ssid_map(ap.host, sshc)
+                ssid_cache_cycle[ap.host] = cycle
+            ssid_by_iface = ssid_cache.get(ap.host, {})
+
+        # the command only depends on the iface list, so rebuild it on change
+        iface_key = tuple(ifaces)
+        cached = remote_cmd_cache.get(ap.host)
+        if cached is not None and cached[0] == iface_key:
+            remote = cached[1]
+        else:
+            remote = build_poll_cmd(ifaces)
+            remote_cmd_cache[ap.host] = (iface_key, remote)
+
+        rc, out, err = ssh_run(ap.host, sshc, remote)
+        if rc != 0:
+            print(f"[warn] ssh failed ap={ap.name} host={ap.host} rc={rc} err={err.strip()}")
+            return {}, {}
+
+        # one pass over the marker lines; sections are handed to the parsers
+        # as slices of the same line list, without re-joining them
+        lines = out.splitlines()
+        listed_ifaces: List[str] = []
+        ifaces_done = False
+        neigh_lines: List[str] = []
+        iface_lines: Dict[str, List[str]] = {}
+        cur_iface: Optional[str] = None
+        start = 0
+
+        for i, ln in enumerate(lines):
+            if not ln.startswith("###"):
+                continue
+            if ln.startswith("###IFACES_BEGIN") or ln.startswith("###NEIGH_BEGIN"):
+                start = i + 1
+            elif ln.startswith("###IFACES_END"):
+                for name_ln in lines[start:i]:
+                    listed_ifaces.extend(name_ln.split())
+                ifaces_done = True
+            elif ln.startswith("###NEIGH_END"):
+                neigh_lines = lines[start:i]
+            elif ln.startswith("###IFACE "):
+                # "###IFACE <iface> BEGIN" / "###IFACE <iface> END"
+                toks = ln.split()
+                if len(toks) == 3 and toks[2] == "BEGIN":
+                    cur_iface = toks[1]
+                    start = i + 1
+                elif len(toks) == 3 and toks[2] == "END":
+                    if cur_iface:
+                        iface_lines[cur_iface] = lines[start:i]
+                    cur_iface = None
+
+        # takes effect from the next cycle
+        if ifaces_done and listed_ifaces != ifaces:
+            print(f"[unifi-ssh-presence] ap={ap.name} wifi ifaces changed: {ifaces} -> {listed_ifaces}")
+            iface_cache[ap.host] = listed_ifaces
+
+        mac_to_ip = parse_ip_neigh(neigh_lines)
+
+        seen_ap_tracked: Dict[str, dict] = {}
+        seen_ap_unknown: Dict[str, dict] = {}
+        tracked_rank: Dict[str, tuple] = {}
+        unknown_rank: Dict[str, tuple] = {}
+
+        for iface, txt_lines in iface_lines.items():
+            macs = parse_wlanconfig_list(txt_lines, extended=extended_mode)
+            for mac, rec in macs.items():
+                if rec.flags & MAC_GROUP_BIT:
+                    continue
+
+                is_randomized = bool(rec.flags & MAC_LOCAL_BIT)
+
+                rec2: Dict[str, object] = {}
+                rec2["mac"] = mac
+                rec2["ap_name"] = ap.name
+                rec2["ap_host"] = ap.host
+                rec2["floor"] = ap.floor
+                rec2["iface"] = iface
+                rec2["band"] = band_from_iface(iface)
+                if rec.rssi is not None:
+                    rec2["rssi"] = rec.rssi
+                if mac in mac_to_ip:
+                    rec2["ip"] = mac_to_ip[mac]
+
+                if extended_mode:
+                    rec2["vap_if"] = iface
+                    ssid = ssid_by_iface.get(iface)
+                    if ssid:
+                        rec2["ssid"] = ssid
+                    for key in STATION_EXTENDED_KEYS:
+                        v = getattr(rec, key)
+                        if v is not None:
+                            rec2[key] = v
+                    if confidence_cfg is not None:
+                        conf_score, conf_breakdown = compute_presence_confidence(rec2, confidence_cfg)
+                        rec2["presence_confidence"] = conf_score
+                        rec2["confidence_breakdown"] = conf_breakdown
+
+                if mac in device_by_mac:
+                    dev = device_by_mac[mac]
+                    if is_randomized and not dev.allow_randomized:
+                        continue
+                    merge_best(seen_ap_tracked, tracked_rank, mac, rec2, rank_key(rec.rssi, rec.idle_s))
+                else:
+                    if learn_mode:
+                        # learn: ignore randomized MACs to avoid noise
+                        if is_randomized:
+                            continue
+                        merge_best(seen_ap_unknown, unknown_rank, mac, rec2, rank_key(rec.rssi, rec.idle_s))
+
+        return seen_ap_tracked, seen_ap_unknown
+    except Exception as e:
+        print(f"[warn] exception on ap={ap.name} host={ap.host}: {e}")
+        return {}, {}
+
+
 def mqtt_connect_wait(cfg: MQTTConfig, timeout_sec: int = 10) -> mqtt.Client:
     connected = {"rc": None}
+    connected_evt = threading.Event()
 
-    def on_connect(client, userdata, flags, rc):
-        connected["rc"] = rc
+    def on_connect(client, userdata, flags, rc, properties=None):
+        # paho 2.x passes a ReasonCode, 1.x a plain int
+        connected["rc"] = getattr(rc, "value", rc)
+        connected_evt.set()
 
-    client = mqtt.Client(client_id=cfg.client_id, clean_session=True)
+    if hasattr(mqtt, "CallbackAPIVersion"):
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=cfg.client_id, clean_session=True)
+    else:
+        client = mqtt.Client(client_id=cfg.client_id, clean_session=True)
     client.on_connect = on_connect
 
     if cfg.username:
@@ -649,13 +1093,7 @@ def mqtt_connect_wait(cfg: MQTTConfig, timeout_sec: int = 10) -> mqtt.Client:
     client.connect_async(cfg.host, cfg.port, keepalive=60)
     client.loop_start()
 
-    start = time.time()
-    while time.time() - start < timeout_sec:
-        if connected["rc"] is not None:
-            break
-        time.sleep(0.1)
-
-    if connected["rc"] is None:
+    if not connected_evt.wait(timeout_sec):
         client.loop_stop()
         raise RuntimeError(f"MQTT connect timeout to {cfg.host}:{cfg.port}")
 
@@ -718,7 +1156,7 @@ def main() -> None:
     for d in devices_raw:
         mac = (d.get("mac") or "").strip().lower()
         name = (d.get("name") or "").strip()
-        if not (mac and name and MAC_RE.match(mac)):
+        if not (mac and name and is_mac(mac)):
             continue
         devices.append(Device(mac=mac, name=name, allow_randomized=bool(d.get("allow_randomized", False))))
 
@@ -739,209 +1177,138 @@ def main() -> None:
     if not ssh_cfg.password:
         raise SystemExit("SSH password is empty. Set it in add-on options.")
 
+    # s6 stops the add-on with SIGTERM; turn it into SystemExit so the atexit
+    # hook below still closes the SSH masters
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    atexit.register(ssh_close_all, ssh_cfg)
+    for ap in aps:
+        try:
+            ssh_session_init(ap.host, ssh_cfg)
+        except Exception as e:
+            # retried lazily by ssh_run on the next poll
+            print(f"[warn] {e}")
+
     print("[unifi-ssh-presence] connecting mqtt...")
     mqc = mqtt_connect_wait(mqtt_cfg, timeout_sec=10)
     print("[unifi-ssh-presence] mqtt connected")
 
     # MQTT discovery
     for dev in devices:
+        dev.topic = combined_topic(mqtt_cfg.base_topic, dev.mac)
         publish_discovery(mqc, mqtt_cfg, dev)
+        clear_legacy_topics(mqc, mqtt_cfg, dev.mac)
 
-    iface_cache: Dict[str, List[str]] = {}
-    iface_refresh_every_cycles = 40  # ~1 hour if poll is 90s
+    # paho reconnects on its own; after that the broker may have lost our
+    # retained messages, so the main loop republishes everything once
+    mqtt_resync = threading.Event()
+
+    def on_reconnect(client, userdata, flags, rc, properties=None):
+        if getattr(rc, "value", rc) == 0:
+            mqtt_resync.set()
 
+    mqc.on_connect = on_reconnect
+
+    iface_cache: Dict[str, List[str]] = {}
     ssid_cache: Dict[str, Dict[str, str]] = {}
     ssid_cache_cycle: Dict[str, int] = {}
-    ssid_refresh_every_cycles = 20  # ~30 minutes if poll is 90s
+    remote_cmd_cache: Dict[str, Tuple[Tuple[str, ...], str]] = {}
+
+    # I/O-bound fan-out: one worker per AP, results merged on this thread
+    executor = ThreadPoolExecutor(max_workers=min(16, len(aps)), thread_name_prefix="ap")
 
     cycle = 0
 
     # tracked state caches (for change-only log)
-    prev_home: Dict[str, Optional[bool]] = {d.mac: None for d in devices}
-    prev_ap: Dict[str, Optional[str]] = {d.mac: None for d in devices}
-    prev_ap_host: Dict[str, Optional[str]] = {d.mac: None for d in devices}
-    prev_floor: Dict[str, Optional[str]] = {d.mac: None for d in devices}
+    # mac -> (is_home, ap_name, ap_host, floor, ip) as of the previous cycle
+    prev_state: Dict[str, Tuple[Optional[bool], Optional[str], Optional[str], Optional[str], Optional[str]]] = {
+        d.mac: (None, None, None, None, None) for d in devices
+    }
     prev_floor_attr: Dict[str, Optional[str]] = {d.mac: None for d in devices}
-    prev_ip: Dict[str, Optional[str]] = {d.mac: None for d in devices}
     last_floor_change: Dict[str, Optional[str]] = {d.mac: None for d in devices}
     roam_count: Dict[str, int] = {d.mac: 0 for d in devices}
+    prev_attrs_hash: Dict[str, int] = {}
 
     misses: Dict[str, int] = {d.mac: 0 for d in devices}
     last_seen: Dict[str, int] = {d.mac: 0 for d in devices}
     last_seen_iso: Dict[str, str] = {d.mac: "" for d in devices}
 
     # learn storage (persistent)
-    seen_unknown: Dict[str, dict] = load_seen_devices() if learn_mode else {}
-    learn_dirty = False
-
+    seen_unknown: Dict[str, dict] = {}
+    seen_log_lines = 0
+    if learn_mode:
+        seen_unknown, seen_log_lines = load_seen_devices()
+        threading.Thread(target=seen_writer_loop, name="seen-writer", daemon=True).start()
+        # atexit runs before daemon threads are stopped, so the writer drains
+        atexit.register(lambda: flush_seen_devices(list(seen_unknown.values())))
+        if seen_unknown and seen_log_lines == 0:
+            # legacy seen_devices.json or a torn log: rewrite it cleanly
+            seen_write_queue.put(("compact", list(seen_unknown.values())))
+            seen_log_lines = len(seen_unknown)
+
+    next_poll = time.monotonic()
     while True:
         cycle += 1
 
+        if mqtt_resync.is_set():
+            mqtt_resync.clear()
+            print("[unifi-ssh-presence] mqtt reconnected, republishing discovery and states")
+            for dev in devices:
+                publish_discovery(mqc, mqtt_cfg, dev)
+            # forces a publish for every device below, unchanged or not
+            prev_attrs_hash.clear()
+
         seen_global_tracked: Dict[str, dict] = {}
         seen_global_unknown: Dict[str, dict] = {}
-
-        for ap in aps:
-            try:
-                if ap.host not in iface_cache or (cycle % iface_refresh_every_cycles == 1):
-                    iface_cache[ap.host] = get_wifi_ifaces(ap.host, ssh_cfg)
-                ifaces = iface_cache[ap.host]
-
-                ssid_by_iface: Dict[str, str] = {}
-                if extended_mode:
-                    ssid_refresh = (
-                        ap.host not in ssid_cache
-                        or (cycle - ssid_cache_cycle.get(ap.host, 0) >= ssid_refresh_every_cycles)
-                    )
-                    if ssid_refresh:
-                        ssid_cache[ap.host] = get_hostapd_ssid_map(ap.host, ssh_cfg)
-                        ssid_cache_cycle[ap.host] = cycle
-                    ssid_by_iface = ssid_cache.get(ap.host, {})
-
-                # Single SSH per AP per cycle; mark sections for parsing
-                parts: List[str] = []
-                parts.append("echo '###NEIGH_BEGIN'")
-                parts.append("ip neigh show 2>/dev/null || true")
-                parts.append("echo '###NEIGH_END'")
-                for iface in ifaces:
-                    parts.append(f"echo '###IFACE {iface} BEGIN'")
-                    parts.append(f"wlanconfig {iface} list 2>/dev/null || true")
-                    parts.append(f"echo '###IFACE {iface} END'")
-                remote = "; ".join(parts)
-
-                rc, out, err = ssh_run(ap.host, ssh_cfg, remote)
-                if rc != 0:
-                    print(f"[warn] ssh failed ap={ap.name} host={ap.host} rc={rc} err={err.strip()}")
-                    continue
-
-                neigh_buf: List[str] = []
-                iface_txt: Dict[str, str] = {}
-                cur_iface: Optional[str] = None
-                buf: List[str] = []
-                in_neigh = False
-
-                for ln in out.splitlines():
-                    if ln.startswith("###NEIGH_BEGIN"):
-                        in_neigh = True
-                        continue
-                    if ln.startswith("###NEIGH_END"):
-                        in_neigh = False
-                        continue
-
-                    m = re.match(r"^###IFACE\s+(\S+)\s+BEGIN$", ln)
-                    if m:
-                        cur_iface = m.group(1)
-                        buf = []
-                        continue
-
-                    m = re.match(r"^###IFACE\s+(\S+)\s+END$", ln)
-                    if m:
-                        if cur_iface:
-                            iface_txt[cur_iface] = "\n".join(buf)
-                        cur_iface = None
-                        buf = []
-                        continue
-
-                    if in_neigh:
-                        neigh_buf.append(ln)
-                    elif cur_iface:
-                        buf.append(ln)
-
-                mac_to_ip = parse_ip_neigh("\n".join(neigh_buf))
-
-                seen_ap_tracked: Dict[str, dict] = {}
-                seen_ap_unknown: Dict[str, dict] = {}
-
-                for iface, txt in iface_txt.items():
-                    macs = parse_wlanconfig_list(txt, extended=extended_mode)
-                    for mac, rec in macs.items():
-                        mac = mac.lower()
-
-                        if is_multicast_or_broadcast(mac):
-                            continue
-
-                        is_randomized = is_randomized_mac(mac)
-
-                        rec2: Dict[str, object] = {}
-                        rec2["mac"] = mac
-                        rec2["ap_name"] = ap.name
-                        rec2["ap_host"] = ap.host
-                        rec2["floor"] = ap.floor
-                        rec2["iface"] = iface
-                        rec2["band"] = band_from_iface(iface)
-                        if "rssi" in rec:
-                            rec2["rssi"] = rec["rssi"]
-                        if mac in mac_to_ip:
-                            rec2["ip"] = mac_to_ip[mac]
-
-                        if extended_mode:
-                            rec2["vap_if"] = iface
-                            ssid = ssid_by_iface.get(iface)
-                            if ssid:
-                                rec2["ssid"] = ssid
-                            for key in (
-                                "chan",
-                                "tx_rate_raw",
-                                "rx_rate_raw",
-                                "tx_mbps",
-                                "rx_mbps",
-                                "min_rssi",
-                                "max_rssi",
-                                "idle_s",
-                                "mode",
-                                "psmode",
-                                "assoctime",
-                            ):
-                                if key in rec:
-                                    rec2[key] = rec[key]
-                            if confidence_enabled:
-                                conf_score, conf_breakdown = compute_presence_confidence(rec2, confidence_cfg)
-                                rec2["presence_confidence"] = conf_score
-                                rec2["confidence_breakdown"] = conf_breakdown
-
-                        if mac in device_by_mac:
-                            dev = device_by_mac[mac]
-                            if is_randomized and not dev.allow_randomized:
-                                continue
-                            seen_ap_tracked[mac] = best_record(seen_ap_tracked.get(mac, rec2), rec2)
-                        else:
-                            if learn_mode:
-                                # learn: ignore randomized MACs to avoid noise
-                                if is_randomized:
-                                    continue
-                                seen_ap_unknown[mac] = best_record(seen_ap_unknown.get(mac, rec2), rec2)
-
-                # merge AP -> global
-                for mac, rec in seen_ap_tracked.items():
-                    seen_global_tracked[mac] = best_record(seen_global_tracked.get(mac, rec), rec)
-
-                if learn_mode:
-                    for mac, rec in seen_ap_unknown.items():
-                        seen_global_unknown[mac] = best_record(seen_global_unknown.get(mac, rec), rec)
-
-            except Exception as e:
-                print(f"[warn] exception on ap={ap.name} host={ap.host}: {e}")
+        tracked_rank: Dict[str, tuple] = {}
+        unknown_rank: Dict[str, tuple] = {}
+
+        results = list(executor.map(
+            lambda ap: poll_ap(
+                ap, ssh_cfg, cycle, device_by_mac, learn_mode, extended_mode,
+                confidence_cfg if confidence_enabled else None,
+                iface_cache, ssid_cache, ssid_cache_cycle, remote_cmd_cache,
+            ),
+            aps,
+        ))
+
+        # merge AP -> global
+        for seen_ap_tracked, seen_ap_unknown in results:
+            for mac, rec in seen_ap_tracked.items():
+                merge_best(seen_global_tracked, tracked_rank, mac, rec, record_rank(rec))
+
+            if learn_mode:
+                for mac, rec in seen_ap_unknown.items():
+                    merge_best(seen_global_unknown, unknown_rank, mac, rec, record_rank(rec))
 
         now_seen_tracked = set(seen_global_tracked.keys())
 
+        # one timestamp for everything seen in this cycle
+        ts, iso = now_ts_iso()
+
         # update misses/last_seen
         for dev in devices:
             mac = dev.mac
             if mac in now_seen_tracked:
                 misses[mac] = 0
-                ts, iso = now_ts_iso()
                 last_seen[mac] = ts
                 last_seen_iso[mac] = iso
             else:
                 misses[mac] += 1
 
-        # tracked publish + change-only logs
+        # tracked publish + change-only logs; MQTT publishes only on change,
+        # plus a periodic heartbeat so HA recovers after a broker restart
+        heartbeat = cycle % PUBLISH_HEARTBEAT_EVERY_CYCLES == 0
+        outbox: List[Tuple[Device, dict]] = []
         for dev in devices:
             mac = dev.mac
             is_home_now = mac in now_seen_tracked
             became_away_now = (not is_home_now) and (misses.get(mac, 0) >= away_after)
+            prev_home, prev_ap, prev_ap_host, prev_floor, prev_ip = prev_state[mac]
 
             if is_home_now:
-                rec = dict(seen_global_tracked[mac])
+                # seen_global_tracked is rebuilt every cycle, so mutate in place
+                rec = seen_global_tracked[mac]
+                rec["state"] = "home"
                 rec["last_seen_ts"] = last_seen.get(mac, 0)
                 rec["last_seen_iso"] = last_seen_iso.get(mac, "")
                 rec["misses"] = misses.get(mac, 0)
@@ -949,47 +1316,46 @@ def main() -> None:
                 rec["last_floor_change"] = last_floor_change.get(mac)
                 rec["roam_count"] = roam_count.get(mac, 0)
 
-                publish_state(mqc, mqtt_cfg, mac, True)
-
                 ap_now = rec.get("ap_name")
                 ap_host_now = rec.get("ap_host")
                 floor_now = rec.get("floor")
                 ip_now = rec.get("ip")
                 rssi_now = rec.get("rssi")
 
-                if prev_ap.get(mac) and ap_now and ap_now != prev_ap[mac]:
+                if prev_ap and ap_now and ap_now != prev_ap:
                     roam_count[mac] = roam_count.get(mac, 0) + 1
                     rec["roam_count"] = roam_count[mac]
 
-                if prev_floor.get(mac) and floor_now and floor_now != prev_floor[mac]:
-                    prev_floor_attr[mac] = prev_floor[mac]
+                if prev_floor and floor_now and floor_now != prev_floor:
+                    prev_floor_attr[mac] = prev_floor
                     last_floor_change[mac] = rec.get("last_seen_iso")
                     rec["prev_floor"] = prev_floor_attr[mac]
                     rec["last_floor_change"] = last_floor_change[mac]
 
-                # republish attrs if roam/floor metadata changed in this cycle
-                publish_attrs(mqc, mqtt_cfg, mac, rec)
-
-                if prev_home[mac] is not True:
-                    print(f"[state] {dev.name}: home (ap={ap_now} floor={floor_now} rssi={rssi_now} ip={ip_now})")
-                elif ap_now != prev_ap[mac]:
-                    print(f"[state] {dev.name}: moved ap={ap_now} (was {prev_ap[mac]}) floor={floor_now} rssi={rssi_now}")
-                elif floor_now and floor_now != prev_floor[mac]:
-                    print(f"[state] {dev.name}: floor={floor_now} (was {prev_floor[mac]})")
-                elif ip_now and ip_now != prev_ip[mac]:
-                    print(f"[state] {dev.name}: ip={ip_now} (was {prev_ip[mac]})")
-
-                prev_home[mac] = True
-                prev_ap[mac] = ap_now
-                prev_ap_host[mac] = ap_host_now
-                prev_floor[mac] = floor_now
-                prev_ip[mac] = ip_now
+                # republish if state or anything but the volatile fields changed
+                h = attrs_signature(rec)
+                if heartbeat or h != prev_attrs_hash.get(mac):
+                    outbox.append((dev, rec))
+                    prev_attrs_hash[mac] = h
+
+                cur_state = (True, ap_now, ap_host_now, floor_now, ip_now)
+                if cur_state != prev_state[mac]:
+                    if prev_home is not True:
+                        print(f"[state] {dev.name}: home (ap={ap_now} floor={floor_now} rssi={rssi_now} ip={ip_now})")
+                    elif ap_now != prev_ap:
+                        print(f"[state] {dev.name}: moved ap={ap_now} (was {prev_ap}) floor={floor_now} rssi={rssi_now}")
+                    elif floor_now and floor_now != prev_floor:
+                        print(f"[state] {dev.name}: floor={floor_now} (was {prev_floor})")
+                    elif ip_now and ip_now != prev_ip:
+                        print(f"[state] {dev.name}: ip={ip_now} (was {prev_ip})")
+                    prev_state[mac] = cur_state
 
             elif became_away_now:
                 away_attrs = {
-                    "ap_name": prev_ap.get(mac),
-                    "ap_host": prev_ap_host.get(mac),
-                    "floor": prev_floor.get(mac),
+                    "state": "not_home",
+                    "ap_name": prev_ap,
+                    "ap_host": prev_ap_host,
+                    "floor": prev_floor,
                     "iface": None,
                     "band": None,
                     "rssi": None,
@@ -1021,20 +1387,22 @@ def main() -> None:
                         away_attrs["presence_confidence"] = None
                         away_attrs["confidence_breakdown"] = None
 
-                publish_state(mqc, mqtt_cfg, mac, False)
-                publish_attrs(mqc, mqtt_cfg, mac, away_attrs)
+                h = attrs_signature(away_attrs)
+                if heartbeat or h != prev_attrs_hash.get(mac):
+                    outbox.append((dev, away_attrs))
+                    prev_attrs_hash[mac] = h
 
-                if prev_home[mac] is not False:
-                    print(f"[state] {dev.name}: not_home (misses={misses.get(mac, 0)} last_ap={prev_ap.get(mac)} floor={prev_floor.get(mac)})")
+                if prev_home is not False:
+                    print(f"[state] {dev.name}: not_home (misses={misses.get(mac, 0)} last_ap={prev_ap} floor={prev_floor})")
+                    # keep the last AP/floor for the away attributes
+                    prev_state[mac] = (False, prev_ap, prev_ap_host, prev_floor, None)
 
-                prev_home[mac] = False
-                prev_ip[mac] = None
+        publish_batch(mqc, outbox)
 
         # learn mode: persist unknown list, log only on change
         if learn_mode and seen_global_unknown:
+            changed: List[dict] = []
             for mac, rec in seen_global_unknown.items():
-                ts, iso = now_ts_iso()
-
                 prev = seen_unknown.get(mac)
                 prev_ip_val = (prev.get("ip") if prev else None)
                 new_ip = rec.get("ip")
@@ -1057,25 +1425,32 @@ def main() -> None:
                 seen_unknown[mac] = new_item
 
                 if is_new:
-                    learn_dirty = True
+                    changed.append(new_item)
                     print(f"[learn] new device seen: {mac} ip={new_item.get('ip')} ap={new_item.get('ap_name')} rssi={new_item.get('rssi')}")
                 elif ip_became_known:
-                    learn_dirty = True
+                    changed.append(new_item)
                     print(f"[learn] device got IPv4: {mac} ip={new_item.get('ip')} ap={new_item.get('ap_name')} rssi={new_item.get('rssi')}")
 
             before_len = len(seen_unknown)
             seen_unknown = trim_seen(seen_unknown, learn_max_entries)
-            if len(seen_unknown) != before_len:
-                learn_dirty = True
-
-            if learn_dirty:
-                try:
-                    save_seen_devices(seen_unknown)
-                except Exception as e:
-                    print(f"[warn] failed saving learn file: {e}")
-                learn_dirty = False
-
-        time.sleep(poll_interval)
+            trimmed = len(seen_unknown) != before_len
+
+            # writes happen on the seen-writer thread
+            if changed:
+                seen_write_queue.put(("append", changed))
+                seen_log_lines += len(changed)
+            if trimmed or seen_log_lines > LEARN_COMPACT_RATIO * max(len(seen_unknown), 1):
+                seen_write_queue.put(("compact", list(seen_unknown.values())))
+                seen_log_lines = len(seen_unknown)
+
+        # fixed cadence: time spent polling comes out of the wait instead of
+        # pushing every later cycle back; after an overrun, don't burst to catch up
+        next_poll += poll_interval
+        delay = next_poll - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_poll = time.monotonic()
 
 
 if __name__ == "__main__":
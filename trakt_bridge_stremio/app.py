@@ -1,22 +1,35 @@
 import asyncio
+import fcntl
 import json
 import os
 import re
 import sys
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import httpx
 import websockets
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response
 
-app = FastAPI()
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import re2 as fast_re
+except ImportError:
+    fast_re = re
 
 DATA_DIR = Path("/data")
 TOKENS_FILE = DATA_DIR / "trakt_tokens.json"
-SENT_FILE = DATA_DIR / "sent_keys.json"
+SENT_FILE = DATA_DIR / "sent_keys.jsonl"
+LEGACY_SENT_FILE = DATA_DIR / "sent_keys.json"  # pre-JSONL format, migrated once
 DEVICE_FLOW_FILE = DATA_DIR / "device_flow.json"
+WS_LOCK_FILE = DATA_DIR / ".ws.lock"
+WS_LOCK_RETRY_SEC = 10
 
 TRAKT_CLIENT_ID = os.getenv("TRAKT_CLIENT_ID", "")
 TRAKT_CLIENT_SECRET = os.getenv("TRAKT_CLIENT_SECRET", "")
@@ -24,26 +37,96 @@ HA_TOKEN = os.getenv("HA_TOKEN", "")
 
 WATCHED_THRESHOLD = float(os.getenv("WATCHED_THRESHOLD", "0.85"))
 MIN_DURATION_SECONDS = int(os.getenv("MIN_DURATION_SECONDS", "600"))
-ENTITIES = set(json.loads(os.getenv("ENTITIES_JSON", "[]")))
+ENTITIES = frozenset(sys.intern(e) for e in json.loads(os.getenv("ENTITIES_JSON", "[]")))
+ENTITIES_SORTED = sorted(ENTITIES)
+# JSON-quoted entity ids: a raw frame without any of them can't be ours
+ENTITY_NEEDLES = tuple(f'"{e}"' for e in ENTITIES)
 
 TRAKT_API = "https://api.trakt.tv"
 TRAKT_OAUTH = "https://api.trakt.tv/oauth"
 
 HA_WS_URL = "ws://homeassistant:8123/api/websocket"
+# state_changed frames for entities with large attributes can exceed the 1 MiB
+# default, which would trip the fail-fast exit
+HA_WS_MAX_SIZE = 4 * 1024 * 1024
+
+# inline (?i): re2's compile() takes no re.* flags
+IMDB_RE = fast_re.compile(r"(tt\d{7,8})")
+EP_RE = fast_re.compile(r"(?i)S(\d{1,2})E(\d{1,2})")
+
+
+def json_loads(data: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 
-IMDB_RE = re.compile(r"(tt\d{7,8})")
-EP_RE = re.compile(r"S(\d{1,2})E(\d{1,2})", re.IGNORECASE)
+def json_dumps(obj: Any, indent: bool = False) -> bytes:
+    # compact unless indent is asked for, matching orjson's default output
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
 
 
-def load_json(path: Path, default):
+def load_json(path: Path, default: Any) -> Any:
     if not path.exists():
         return default
-    return json.loads(path.read_text(encoding="utf-8"))
+    return json_loads(path.read_bytes())
 
 
-def save_json(path: Path, obj):
+def save_json(path: Path, obj: Any) -> None:
+    # pretty-printed: only used for the small files a human may inspect (tokens,
+    # device flow); SENT_FILE is written compact by append_sent()
+    # write + rename, so a crash mid-write never leaves a truncated file
     path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_text(json.dumps(obj, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp = path.with_suffix(".tmp")
+    tmp.write_bytes(json_dumps(obj, indent=True))
+    os.replace(tmp, path)
+
+
+def append_sent(items: List[Tuple[str, Dict[str, Any]]]) -> None:
+    SENT_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with SENT_FILE.open("ab") as f:
+        f.write(b"".join(json_dumps([key, entry]) + b"\n" for key, entry in items))
+
+
+def load_sent(owner: bool) -> Dict[str, Dict[str, Any]]:
+    """
+    SENT_FILE is append-only JSONL, one [key, entry] pair per line, so it is
+    streamed line by line instead of parsed as one document.
+    Only the websocket lock holder (owner) migrates or repairs the file.
+    """
+    sent: Dict[str, Dict[str, Any]] = {}
+    if not SENT_FILE.exists():
+        if LEGACY_SENT_FILE.exists():
+            sent = load_json(LEGACY_SENT_FILE, {})
+            if owner:
+                append_sent(list(sent.items()))
+                print(f"[sent] migrated {len(sent)} keys from {LEGACY_SENT_FILE.name} to {SENT_FILE.name}")
+        return sent
+
+    good = 0
+    with SENT_FILE.open("r+b" if owner else "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                # torn tail from a crash mid-append; cut it so the next append starts clean
+                if owner:
+                    f.truncate(good)
+                break
+            good += len(line)
+            try:
+                key, entry = json_loads(line)
+            except (ValueError, TypeError):
+                continue
+            sent[key] = entry
+    return sent
+
+
+# sent keys live in memory; SENT_FILE is read at startup (ws_owner) and each
+# new key is appended by handle_stop right after its Trakt sync
+SENT: Dict[str, Dict[str, Any]] = {}
 
 
 def trakt_headers(access_token: str) -> Dict[str, str]:
@@ -68,27 +151,49 @@ def parse_episode(media_title: str) -> Optional[Tuple[int, int]]:
     m = EP_RE.search(media_title)
     if not m:
         return None
-    return int(m.group(1)), int(m.group(2))
+    season, episode = m.groups()
+    return int(season), int(episode)
 
 
 def is_stremio(attrs: Dict[str, Any]) -> bool:
     return (attrs.get("app_name") or "") == "Stremio"
 
 
+# TOKENS_FILE is only re-read when its mtime changes; auth_device_poll may run
+# in a different worker than the websocket
+trakt_access_token: Optional[str] = None
+tokens_mtime: Optional[int] = None
+
+
+def refresh_trakt_token() -> Optional[str]:
+    global trakt_access_token, tokens_mtime
+    try:
+        mtime: Optional[int] = TOKENS_FILE.stat().st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if mtime != tokens_mtime:
+        tokens_mtime = mtime
+        trakt_access_token = (load_json(TOKENS_FILE, None) or {}).get("access_token")
+    return trakt_access_token
+
+
 def is_authorized_trakt() -> bool:
-    tokens = load_json(TOKENS_FILE, None)
-    return bool(tokens and tokens.get("access_token"))
+    return bool(refresh_trakt_token())
+
+
+# one pooled client for all Trakt calls, so the TLS connection is kept alive;
+# created and closed in lifespan
+http_client: Optional[httpx.AsyncClient] = None
 
 
 async def trakt_add_to_history(access_token: str, body: Dict[str, Any]) -> None:
-    async with httpx.AsyncClient(timeout=20) as client:
-        r = await client.post(
-            f"{TRAKT_API}/sync/history",
-            headers=trakt_headers(access_token),
-            json=body,
-        )
-        if r.status_code not in (200, 201):
-            raise RuntimeError(f"Trakt error {r.status_code}: {r.text}")
+    r = await http_client.post(
+        f"{TRAKT_API}/sync/history",
+        headers=trakt_headers(access_token),
+        json=body,
+    )
+    if r.status_code not in (200, 201):
+        raise RuntimeError(f"Trakt error {r.status_code}: {r.text}")
 
 
 async def handle_stop(entity_id: str, attrs: Dict[str, Any]) -> None:
@@ -103,6 +208,11 @@ async def handle_stop(entity_id: str, attrs: Dict[str, Any]) -> None:
     if duration <= 0 or duration < MIN_DURATION_SECONDS:
         return
 
+    # most stops are pauses below the threshold: reject before any regex work
+    progress = pos / duration
+    if progress < WATCHED_THRESHOLD:
+        return
+
     imdb = parse_imdb(attrs.get("entity_picture") or "")
     if not imdb:
         return
@@ -112,10 +222,6 @@ async def handle_stop(entity_id: str, attrs: Dict[str, Any]) -> None:
     if ep:
         season, episode = ep
 
-    progress = pos / duration
-    if progress < WATCHED_THRESHOLD:
-        return
-
     if season is not None and episode is not None:
         key = f"{imdb}:S{season:02d}E{episode:02d}"
         body = {
@@ -132,12 +238,10 @@ async def handle_stop(entity_id: str, attrs: Dict[str, Any]) -> None:
         body = {"movies": [{"ids": {"imdb": imdb}}]}
         kind = "movie"
 
-    sent = load_json(SENT_FILE, {})
-    if key in sent:
+    if key in SENT:
         return
 
-    tokens = load_json(TOKENS_FILE, None)
-    access_token = (tokens or {}).get("access_token")
+    access_token = refresh_trakt_token()
     if not access_token:
         return
 
@@ -147,7 +251,7 @@ async def handle_stop(entity_id: str, attrs: Dict[str, Any]) -> None:
         print(f"[trakt] failed: {e}")
         return
 
-    sent[key] = {
+    entry = {
         "title": title,
         "imdb": imdb,
         "season": season,
@@ -157,105 +261,237 @@ async def handle_stop(entity_id: str, attrs: Dict[str, Any]) -> None:
         "duration": round(duration, 2),
         "entity_id": entity_id,
     }
-    save_json(SENT_FILE, sent)
+    SENT[key] = entry
+    # written synchronously: no await between the successful POST and the
+    # append, so a cancel or fail-fast exit can't drop a key Trakt already has
+    try:
+        append_sent([(key, entry)])
+    except OSError as e:
+        print(f"[sent] save failed: {e}")
 
     print(f"[trakt] SENT {kind}: {key} progress={round(progress*100,1)}% title='{title}'")
 
 
-async def ha_ws_once_failfast():
+# stop transitions are handed from the websocket reader to stop_worker, so a
+# slow Trakt POST never stalls frame consumption
+STOP_QUEUE_MAX = 128
+STOP_DRAIN_TIMEOUT_SEC = 25  # > the 20 s Trakt client timeout
+stop_q: "asyncio.Queue[Tuple[str, Dict[str, Any]]]" = asyncio.Queue(maxsize=STOP_QUEUE_MAX)
+
+
+async def stop_worker() -> None:
+    # single consumer: the SENT check + POST + insert stays race-free
+    while True:
+        entity_id, attrs = await stop_q.get()
+        try:
+            await handle_stop(entity_id, attrs)
+        except Exception as e:
+            print(f"[trakt] stop handling failed for {entity_id}: {e}")
+        finally:
+            stop_q.task_done()
+
+
+async def drain_stop_queue() -> None:
+    # give stops already read from HA a chance to reach Trakt before exiting
+    try:
+        await asyncio.wait_for(stop_q.join(), STOP_DRAIN_TIMEOUT_SEC)
+    except asyncio.TimeoutError:
+        print(f"[trakt] exiting with {stop_q.qsize()} stop event(s) unprocessed")
+
+
+async def ha_ws_once_failfast() -> None:
     if not HA_TOKEN:
         print("[ha] HA_TOKEN missing; exiting (fail-fast).")
         sys.exit(1)
 
     try:
-        async with websockets.connect(HA_WS_URL, ping_interval=30, ping_timeout=30) as ws:
-            hello = json.loads(await ws.recv())
+        # compression=None: the link to HA is container-local, so inflating
+        # every frame would cost CPU for no bandwidth gain
+        async with websockets.connect(
+            HA_WS_URL,
+            ping_interval=30,
+            ping_timeout=30,
+            max_size=HA_WS_MAX_SIZE,
+            compression=None,
+        ) as ws:
+            hello = json_loads(await ws.recv())
             if hello.get("type") != "auth_required":
                 print(f"[ha] unexpected hello: {hello}. Exiting (fail-fast).")
                 sys.exit(1)
 
             await ws.send(json.dumps({"type": "auth", "access_token": HA_TOKEN}))
-            auth_resp = json.loads(await ws.recv())
+            auth_resp = json_loads(await ws.recv())
             if auth_resp.get("type") != "auth_ok":
                 print(f"[ha] auth failed: {auth_resp}. Exiting (fail-fast).")
                 sys.exit(1)
 
-            await ws.send(json.dumps({"id": 1, "type": "subscribe_events", "event_type": "state_changed"}))
-            sub_resp = json.loads(await ws.recv())
-            if sub_resp.get("type") != "result" or not sub_resp.get("success", False):
-                print(f"[ha] subscribe failed: {sub_resp}. Exiting (fail-fast).")
-                sys.exit(1)
-
-            print(f"[ha] subscribed. Watching entities: {sorted(ENTITIES)} (Stremio only)")
+            # Let HA filter: a state trigger on our entities, "from: playing",
+            # delivers only the transitions we act on instead of every
+            # state_changed in the instance.
+            trigger_mode = False
+            if ENTITIES:
+                await ws.send(json.dumps({
+                    "id": 1,
+                    "type": "subscribe_trigger",
+                    "trigger": {"platform": "state", "entity_id": ENTITIES_SORTED, "from": "playing"},
+                }))
+                sub_resp = json_loads(await ws.recv())
+                trigger_mode = sub_resp.get("type") == "result" and sub_resp.get("success", False)
+                if not trigger_mode:
+                    print(f"[ha] subscribe_trigger rejected: {sub_resp}. Falling back to state_changed.")
+
+            if not trigger_mode:
+                await ws.send(json.dumps({"id": 2, "type": "subscribe_events", "event_type": "state_changed"}))
+                sub_resp = json_loads(await ws.recv())
+                if sub_resp.get("type") != "result" or not sub_resp.get("success", False):
+                    print(f"[ha] subscribe failed: {sub_resp}. Exiting (fail-fast).")
+                    sys.exit(1)
+
+            mode = "state trigger" if trigger_mode else "state_changed"
+            print(f"[ha] subscribed ({mode}). Watching entities: {ENTITIES_SORTED} (Stremio only)")
+
+            # hot loop: globals and bound methods as locals, subscripts where
+            # HA's event format guarantees the key
+            loads = json_loads
+            entities = ENTITIES
+            needles = ENTITY_NEEDLES
+            enqueue = stop_q.put_nowait
 
             async for msg in ws:
-                data = json.loads(msg)
+                # broad subscription: skip the full parse of other entities' frames
+                if not trigger_mode and isinstance(msg, str) and not any(n in msg for n in needles):
+                    continue
+
+                data: Dict[str, Any] = loads(msg)
                 if data.get("type") != "event":
                     continue
 
-                event = data.get("event", {})
-                if event.get("event_type") != "state_changed":
+                ev: Dict[str, Any]
+                try:
+                    event: Dict[str, Any] = data["event"]
+                    if trigger_mode:
+                        ev = event["variables"]["trigger"]
+                        new_state = ev["to_state"]
+                        old_state = ev["from_state"]
+                    else:
+                        if event["event_type"] != "state_changed":
+                            continue
+                        ev = event["data"]
+                        new_state = ev["new_state"]
+                        old_state = ev["old_state"]
+                except (KeyError, TypeError):
                     continue
 
-                ev = event.get("data", {})
-                entity_id = ev.get("entity_id")
-                if not entity_id or entity_id not in ENTITIES:
+                entity_id: Optional[str] = ev.get("entity_id")
+                if not entity_id or entity_id not in entities:
                     continue
 
-                new_state = ev.get("new_state")
-                old_state = ev.get("old_state")
                 if not new_state or not old_state:
                     continue
 
-                new_s = new_state.get("state")
-                old_s = old_state.get("state")
-                new_attrs = new_state.get("attributes") or {}
-                old_attrs = old_state.get("attributes") or {}
+                # watched decision on transition FROM playing -> anything else;
+                # tested first since most frames aren't such a transition
+                if old_state["state"] != "playing" or new_state["state"] == "playing":
+                    continue
 
                 # filter only Stremio
-                if not is_stremio(new_attrs) and not is_stremio(old_attrs):
+                old_attrs = old_state.get("attributes") or {}
+                if not is_stremio(old_attrs) and not is_stremio(new_state.get("attributes") or {}):
                     continue
 
-                # watched decision on transition FROM playing -> anything else
-                if old_s == "playing" and new_s != "playing":
-                    await handle_stop(entity_id, old_attrs)
+                try:
+                    enqueue((entity_id, old_attrs))
+                except asyncio.QueueFull:
+                    print(f"[ha] stop queue full; dropping stop event for {entity_id}")
 
     except Exception as e:
         print(f"[ha] websocket error: {e}. Exiting (fail-fast).")
+        await drain_stop_queue()
         sys.exit(1)
 
 
-@app.on_event("startup")
-async def startup_event():
-    asyncio.create_task(ha_ws_once_failfast())
+def acquire_ws_lock() -> Optional[int]:
+    """
+    Non-blocking flock on WS_LOCK_FILE. With several uvicorn workers only the
+    holder runs the HA websocket (and so the Trakt sync and SENT writes); the
+    rest serve HTTP. Returns the fd to keep open, or None if taken.
+    """
+    WS_LOCK_FILE.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(WS_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+async def ws_owner() -> None:
+    # uvicorn doesn't respawn workers, so when the holder exits fail-fast a
+    # waiting worker takes the lock over instead of syncing stopping silently
+    ws_lock = acquire_ws_lock()
+    if ws_lock is None:
+        print(f"[ha] websocket owned by another worker; retrying the lock every {WS_LOCK_RETRY_SEC}s")
+        SENT.update(load_sent(owner=False))
+        while ws_lock is None:
+            await asyncio.sleep(WS_LOCK_RETRY_SEC)
+            ws_lock = acquire_ws_lock()
+        print("[ha] websocket lock acquired; taking over")
+
+    worker: Optional[asyncio.Task] = None
+    try:
+        sent = load_sent(owner=True)
+        SENT.clear()
+        SENT.update(sent)
+        worker = asyncio.create_task(stop_worker())
+        await ha_ws_once_failfast()
+    finally:
+        if worker is not None:
+            worker.cancel()
+        os.close(ws_lock)
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    global http_client
+    http_client = httpx.AsyncClient(timeout=20)
+    owner = asyncio.create_task(ws_owner())
+    try:
+        yield
+    finally:
+        owner.cancel()
+        await asyncio.gather(owner, return_exceptions=True)
+        await http_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+# static part of /health; config doesn't change while running
+HEALTH_CONFIG = {
+    "entities": ENTITIES_SORTED,
+    "watched_threshold": WATCHED_THRESHOLD,
+    "min_duration_seconds": MIN_DURATION_SECONDS,
+    "ws_url": HA_WS_URL,
+    "trakt_oauth": TRAKT_OAUTH,
+}
 
 
 @app.get("/health")
 def health():
-    return {
-        "ok": True,
-        "authorized_trakt": is_authorized_trakt(),
-        "entities": sorted(ENTITIES),
-        "watched_threshold": WATCHED_THRESHOLD,
-        "min_duration_seconds": MIN_DURATION_SECONDS,
-        "ws_url": HA_WS_URL,
-        "trakt_oauth": TRAKT_OAUTH,
-    }
+    return {"ok": True, "authorized_trakt": is_authorized_trakt(), **HEALTH_CONFIG}
 
 
 @app.get("/status")
 def status():
-    sent = load_json(SENT_FILE, {})
     return {
         "authorized_trakt": is_authorized_trakt(),
-        "sent_count": len(sent),
-        "watching_entities": sorted(ENTITIES),
+        "sent_count": len(SENT),
+        "watching_entities": ENTITIES_SORTED,
     }
 
 
-@app.get("/", response_class=HTMLResponse)
-def index():
-    return """
+INDEX_HTML = """
 <!doctype html>
 <html>
 <head>
@@ -347,33 +583,44 @@ refreshStatus();
 </html>
 """
 
+# static page: encoded once, served as-is and cacheable by the browser
+INDEX_BYTES = INDEX_HTML.encode("utf-8")
+
+
+@app.get("/", response_class=HTMLResponse)
+def index():
+    return Response(
+        content=INDEX_BYTES,
+        media_type="text/html; charset=utf-8",
+        headers={"Cache-Control": "public, max-age=300"},
+    )
+
 
 @app.post("/auth/device/start")
 async def auth_device_start():
     if not TRAKT_CLIENT_ID:
         raise HTTPException(400, "Missing TRAKT_CLIENT_ID (vyplň v konfiguraci add-onu)")
 
-    async with httpx.AsyncClient(timeout=20) as client:
-        r = await client.post(
-            f"{TRAKT_OAUTH}/device/code",
-            json={"client_id": TRAKT_CLIENT_ID},
-            headers={"Content-Type": "application/json"},
+    r = await http_client.post(
+        f"{TRAKT_OAUTH}/device/code",
+        json={"client_id": TRAKT_CLIENT_ID},
+        headers={"Content-Type": "application/json"},
+    )
+
+    if r.status_code != 200:
+        raise HTTPException(
+            status_code=502,
+            detail=f"Trakt device/code failed: {r.status_code} {r.text}",
         )
 
-        if r.status_code != 200:
-            raise HTTPException(
-                status_code=502,
-                detail=f"Trakt device/code failed: {r.status_code} {r.text}",
-            )
-
-        data = r.json()
-        save_json(DEVICE_FLOW_FILE, data)
-        return {
-            "user_code": data.get("user_code"),
-            "verification_url": data.get("verification_url"),
-            "expires_in": data.get("expires_in"),
-            "interval": data.get("interval"),
-        }
+    data = r.json()
+    await asyncio.to_thread(save_json, DEVICE_FLOW_FILE, data)
+    return {
+        "user_code": data.get("user_code"),
+        "verification_url": data.get("verification_url"),
+        "expires_in": data.get("expires_in"),
+        "interval": data.get("interval"),
+    }
 
 
 @app.post("/auth/device/poll")
@@ -381,7 +628,7 @@ async def auth_device_poll():
     if not (TRAKT_CLIENT_ID and TRAKT_CLIENT_SECRET):
         raise HTTPException(400, "Missing TRAKT_CLIENT_ID or TRAKT_CLIENT_SECRET (vyplň v konfiguraci add-onu)")
 
-    flow = load_json(DEVICE_FLOW_FILE, None)
+    flow = await asyncio.to_thread(load_json, DEVICE_FLOW_FILE, None)
     if not flow:
         raise HTTPException(400, "Device flow not started. Call /auth/device/start first.")
 
@@ -391,16 +638,15 @@ async def auth_device_poll():
         "client_secret": TRAKT_CLIENT_SECRET,
     }
 
-    async with httpx.AsyncClient(timeout=20) as client:
-        r = await client.post(
-            f"{TRAKT_OAUTH}/device/token",
-            json=payload,
-            headers={"Content-Type": "application/json"},
-        )
+    r = await http_client.post(
+        f"{TRAKT_OAUTH}/device/token",
+        json=payload,
+        headers={"Content-Type": "application/json"},
+    )
 
-        if r.status_code == 200:
-            tokens = r.json()
-            save_json(TOKENS_FILE, tokens)
-            return {"ok": True, "message": "Authorized. Tokens saved to /data."}
+    if r.status_code == 200:
+        tokens = r.json()
+        await asyncio.to_thread(save_json, TOKENS_FILE, tokens)
+        return {"ok": True, "message": "Authorized. Tokens saved to /data."}
 
-        return {"ok": False, "status_code": r.status_code, "body": r.text}
+    return {"ok": False, "status_code": r.status_code, "body": r.text}
@@ -19,4 +19,5 @@ if [ -z "$HA_TOKEN" ]; then
 fi
 
 bashio::log.info "Starting Trakt Bridge (Stremio) on :8787"
-exec uvicorn app:app --host 0.0.0.0 --port 8787
+# --loop auto picks uvloop (requirements.txt) and falls back to asyncio
+exec uvicorn app:app --host 0.0.0.0 --port 8787 --loop auto